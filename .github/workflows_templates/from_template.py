@@ -273,12 +273,12 @@ install_remote_windows = \
 # Runs tests on Windows
 test_windows = \
 r"""  python -m pip install numpy &&
-  python -m pip install iisignature pytest &&
+  python -m pip install iisignature pytest pytest-xdist &&
   python -c "import os;
   import subprocess;
   import sys;
   print(sys.version);
-  returncode_test = subprocess.Popen('python command.py test', shell=True).wait();
+  returncode_test = subprocess.Popen('python command.py test -a -n auto', shell=True).wait();
   returncode_version = sys.version[:5] != os.environ['PYTHON_VERSION'][:5];
   sys.exit(max(returncode_test, returncode_version))
   " &&""",
@@ -325,12 +325,12 @@ install_remote_linux = \
 # Runs tests on Linux
 test_linux = \
 r"""  python -m pip install numpy
-  python -m pip install iisignature pytest
+  python -m pip install iisignature pytest pytest-xdist
   python -c "import os
   import subprocess
   import sys
   print(sys.version)
-  returncode_test = subprocess.Popen('python command.py test', shell=True).wait()
+  returncode_test = subprocess.Popen('python command.py test -a -n auto', shell=True).wait()
   returncode_version = sys.version[:5] != os.environ['PYTHON_VERSION'][:5]
   sys.exit(max(returncode_test, returncode_version))
   " """,
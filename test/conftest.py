@@ -19,7 +19,9 @@ import copy
 import pytest
 import signatory
 import sys
+import torch
 
+from helpers import helpers as h
 from helpers import validation as v
 
 
@@ -35,6 +37,7 @@ def pytest_addoption(parser):
 
 def pytest_configure(config):
     config.addinivalue_line('markers', 'slow: mark a test as being slow and excluded from default test runs')
+    config.addinivalue_line('markers', 'cuda_only: mark a test as requiring CUDA, and skipped if it is not available')
     if not config.option.slow:
         if hasattr(config.option, 'markexpr') and len(config.option.markexpr) > 0:
             config.option.markexpr = '(' + config.option.markexpr + ') and not slow'
@@ -42,6 +45,34 @@ def pytest_configure(config):
             config.option.markexpr = 'not slow'
 
 
+_random_sizes = None
+
+
+def random_sizes():
+    """Like helpers.random_sizes, but sampled only once per session, with a fixed seed.
+
+    This means that every test sees the same sizes (so that anything cached on them can be shared between tests), and
+    that failures are reproducible.
+    """
+    global _random_sizes
+    if _random_sizes is None:
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(0)
+            _random_sizes = h.random_sizes()
+    return _random_sizes
+
+
+def pytest_generate_tests(metafunc):
+    if 'sizes' in metafunc.fixturenames:
+        sizes = random_sizes()
+        metafunc.parametrize('sizes', sizes, ids=['x'.join(str(elem) for elem in size) for size in sizes])
+
+
+def pytest_runtest_setup(item):
+    if item.get_closest_marker('cuda_only') is not None and not torch.cuda.is_available():
+        pytest.skip('CUDA not available')
+
+
 def pytest_collection_finish(session):
     cycle = v.signatory_functionality_graph.get_cycle()
     if cycle is not None:
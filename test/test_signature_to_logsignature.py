@@ -16,8 +16,10 @@
 
 
 import gc
+import inspect
 import pytest
 import torch
+from torch import autograd
 import warnings
 import weakref
 
@@ -30,100 +32,199 @@ depends = ['signature', 'logsignature']
 signatory = v.validate_tests(tests, depends)
 
 
+# fast_mode was only added to gradcheck in PyTorch 1.9.0.
+_gradcheck_has_fast_mode = 'fast_mode' in inspect.signature(autograd.gradcheck).parameters
+
+
+# Resolved once here, so that every test uses the same object, and so that a misspelling fails at collection time
+# rather than deep inside autograd.gradcheck.
+_SignatureToLogsignature = signatory.SignatureToLogsignature
+if not callable(_SignatureToLogsignature):
+    raise RuntimeError('Expected signatory.SignatureToLogsignature to be callable')
+
+
+devices = [pytest.param(device, marks=pytest.mark.cuda_only) if device == 'cuda' else device
+           for device in h.get_devices()]
+
+
 def signatory_signature_to_logsignature(class_, signature, input_channels, depth, stream, mode, scalar_term):
     if class_:
-        return signatory.SignatureToLogsignature(input_channels, depth, stream=stream, mode=mode,
-                                                 scalar_term=scalar_term)(signature)
+        return _SignatureToLogsignature(input_channels, depth, stream=stream, mode=mode,
+                                        scalar_term=scalar_term)(signature)
     else:
         return signatory.signature_to_logsignature(signature, input_channels, depth, stream=stream, mode=mode,
                                                    scalar_term=scalar_term)
 
-def test_forward():
-    """Tests that the forward calculations produce the correct values."""
-    for class_ in (False, True):
-        for device in h.get_devices():
-            for batch_size, input_stream, input_channels in h.random_sizes():
-                for depth in (1, 2, 4, 6):
-                    for stream in (False, True):
-                        for mode in h.all_modes:
-                            for signature_grad in (False, True):
-                                for scalar_term in (False, True):
-                                    _test_forward(class_, device, batch_size, input_stream, input_channels, depth,
-                                                  stream, mode, signature_grad, scalar_term)
-
-
-def _test_forward(class_, device, batch_size, input_stream, input_channels, depth, stream, mode, signature_grad,
-                  scalar_term):
-    path = h.get_path(batch_size, input_stream, input_channels, device, path_grad=False)
-    signature = signatory.signature(path, depth, stream=stream, scalar_term=scalar_term)
-    if signature_grad:
-        signature.requires_grad_()
+
+@pytest.fixture(scope='module')
+def signature_cache():
+    """Maps (batch_size, input_stream, input_channels, device, depth, stream, scalar_term) to a (path, signature) pair.
+
+    The same signature is needed along every other axis of the test matrix, so we only compute it once. The cache is
+    emptied once this module's tests have finished, so that its memory isn't held whilst other modules run.
+    """
+    cache = {}
+    yield cache
+    cache.clear()
+
+
+@pytest.fixture
+def signature_for(signature_cache):
+    """Returns a function that gets a path and its signature, memoised via the signature_cache fixture.
+
+    Only CPU tensors are cached, so that the cache doesn't count towards the GPU memory measured by
+    test_repeat_and_memory_leaks. The cached signature is detached, so that no autograd graph is kept alive between
+    tests. Clones are returned, so that nothing a test does to them can affect the cache.
+    """
+    def _signature_for(batch_size, input_stream, input_channels, device, depth, stream, scalar_term):
+        key = (batch_size, input_stream, input_channels, device, depth, stream, scalar_term)
+        try:
+            path, signature = signature_cache[key]
+        except KeyError:
+            path = h.get_path(batch_size, input_stream, input_channels, device, path_grad=False)
+            signature = signatory.signature(path, depth, stream=stream, scalar_term=scalar_term).detach()
+            if device == 'cpu':
+                signature_cache[key] = path, signature
+        return path.clone(), signature.clone()
+    return _signature_for
+
+
+def _ctx_ref(logsignature, stream):
+    """Returns a weak reference to the backward context that produced the logsignature.
+
+    The context is only ever held by a local variable here, so that no strong reference to it outlives this function.
+    """
+    ctx = logsignature.grad_fn
+    if stream:
+        ctx = ctx.next_functions[0][0]
+    assert type(ctx).__name__ == '_SignatureToLogsignatureFunctionBackward'
+    return weakref.ref(ctx)
+
+
+@pytest.mark.parametrize('scalar_term', (False, True))
+@pytest.mark.parametrize('signature_grad', (False, True))
+@pytest.mark.parametrize('mode', h.all_modes)
+@pytest.mark.parametrize('stream', (False, True))
+@pytest.mark.parametrize('depth', (1, 2, 4, 6))
+@pytest.mark.parametrize('device', devices)
+def test_forward(device, sizes, depth, stream, mode, signature_grad, scalar_term, signature_for):
+    """Tests that the forward calculations produce the correct values.
+
+    Both the function and the class are tested here, against the same signature.
+    """
+    batch_size, input_stream, input_channels = sizes
+    path, signature = signature_for(batch_size, input_stream, input_channels, device, depth, stream, scalar_term)
+    signature.requires_grad_(signature_grad)
     with warnings.catch_warnings():
         warnings.filterwarnings('ignore', message="The logsignature with mode='brackets' has been requested on the "
                                                   "GPU.", category=UserWarning)
-        logsignature = signatory_signature_to_logsignature(class_, signature, input_channels, depth, stream, mode,
+        logsignature = signatory_signature_to_logsignature(False, signature, input_channels, depth, stream, mode,
                                                            scalar_term=scalar_term)
+        class_logsignature = signatory_signature_to_logsignature(True, signature, input_channels, depth, stream, mode,
+                                                                 scalar_term=scalar_term)
         true_logsignature = signatory.logsignature(path, depth, stream=stream, mode=mode)
     h.diff(logsignature, true_logsignature)
+    h.diff(class_logsignature, logsignature)
 
     if signature_grad:
-        ctx = logsignature.grad_fn
-        if stream:
-            ctx = ctx.next_functions[0][0]
-        assert type(ctx).__name__ == '_SignatureToLogsignatureFunctionBackward'
-        ref = weakref.ref(ctx)
-        del ctx
+        ref = _ctx_ref(logsignature, stream)
+        class_ref = _ctx_ref(class_logsignature, stream)
         del logsignature
-        gc.collect()
+        del class_logsignature
+        # No gc.collect() needed: the graph has no reference cycles, so reference counting alone should free it.
         assert ref() is None
+        assert class_ref() is None
     else:
         assert logsignature.grad_fn is None
+        assert class_logsignature.grad_fn is None
+
 
+@pytest.mark.parametrize('mode', h.all_modes)
+@pytest.mark.parametrize('stream', (False, True))
+@pytest.mark.parametrize('device', devices)
+def test_class_forward(device, stream, mode, signature_for):
+    """A quick smoke check of the class on its own, against signatory.logsignature, for a single fixed size.
 
-def test_backward_expand_words():
+    The comparison between the class and the function, over all sizes, is done in test_forward.
+    """
+    batch_size, input_stream, input_channels, depth = 2, 4, 3, 3
+    path, signature = signature_for(batch_size, input_stream, input_channels, device, depth, stream, False)
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message="The logsignature with mode='brackets' has been requested on the "
+                                                  "GPU.", category=UserWarning)
+        logsignature = _SignatureToLogsignature(input_channels, depth, stream=stream, mode=mode)(signature)
+        true_logsignature = signatory.logsignature(path, depth, stream=stream, mode=mode)
+    h.diff(logsignature, true_logsignature)
+
+
+@pytest.mark.parametrize('scalar_term', (False, True))
+@pytest.mark.parametrize('mode', (h.expand_mode, h.words_mode))
+@pytest.mark.parametrize('stream', (False, True))
+@pytest.mark.parametrize('depth', (1, 2, 4, 6))
+@pytest.mark.parametrize('device', devices)
+@pytest.mark.parametrize('class_', (False, True))
+def test_backward_expand_words(class_, device, sizes, depth, stream, mode, scalar_term):
     """Tests that the backward calculations produce the correct values."""
-    for class_ in (False, True):
-        for device in h.get_devices():
-            for batch_size, input_stream, input_channels in h.random_sizes():
-                for depth in (1, 2, 4, 6):
-                    for stream in (False, True):
-                        for mode in (h.expand_mode, h.words_mode):
-                            for scalar_term in (False, True):
-                                _test_backward(class_, device, batch_size, input_stream, input_channels, depth, stream,
-                                               mode, scalar_term)
+    _test_backward(class_, device, sizes, depth, stream, mode, scalar_term)
 
 
 @pytest.mark.slow
-def test_backward_brackets():
+@pytest.mark.parametrize('scalar_term', (False, True))
+@pytest.mark.parametrize('mode', (h.brackets_mode,))
+@pytest.mark.parametrize('stream', (False, True))
+@pytest.mark.parametrize('depth', (1, 2, 4, 6))
+@pytest.mark.parametrize('device', devices)
+@pytest.mark.parametrize('class_', (False, True))
+def test_backward_brackets(class_, device, sizes, depth, stream, mode, scalar_term):
     """Tests that the backward calculations produce the correct values."""
-    for class_ in (False, True):
-        for device in h.get_devices():
-            for batch_size, input_stream, input_channels in h.random_sizes():
-                for depth in (1, 2, 4, 6):
-                    for stream in (False, True):
-                        for mode in (h.brackets_mode,):
-                            for scalar_term in (False, True):
-                                _test_backward(class_, device, batch_size, input_stream, input_channels, depth, stream,
-                                               mode, scalar_term)
-
-
-def _test_backward(class_, device, batch_size, input_stream, input_channels, depth, stream, mode, scalar_term):
-
-    # This test (in the comment below) runs out of memory! So we don't do this, and do something else instead.
-    #
-    # path = h.get_path(batch_size, input_stream, input_channels, device, path_grad=False)
-    # signature = signatory.signature(path, depth, stream=stream)
-    # signature.requires_grad_()
-    # if class_:
-    #     def check_fn(signature):
-    #         return signatory.SignatureToLogSignature(input_channels, depth, stream=stream, mode=mode)(signature)
-    # else:
-    #     def check_fn(signature):
-    #         return signatory.signature_to_logsignature(signature, input_channels, depth, stream=stream, mode=mode)
-    # try:
-    #     autograd.gradcheck(check_fn, (signature,), atol=2e-05, rtol=0.002)
-    # except RuntimeError:
-    #     pytest.fail()
+    _test_backward(class_, device, sizes, depth, stream, mode, scalar_term)
+
+
+# A full gradcheck materialises the whole Jacobian, and perturbs every element of the signature, so this is only done
+# for the small sizes and depths.
+@pytest.mark.slow
+@pytest.mark.parametrize('scalar_term', (False, True))
+@pytest.mark.parametrize('mode', h.all_modes)
+@pytest.mark.parametrize('stream', (False, True))
+@pytest.mark.parametrize('depth', (1, 2, 3))
+@pytest.mark.parametrize('small_sizes', [(batch_size, 2, input_channels) for batch_size in (1, 2)
+                                         for input_channels in (1, 2)])
+@pytest.mark.parametrize('device', devices)
+@pytest.mark.parametrize('class_', (False, True))
+def test_backward_gradcheck_exhaustive(class_, device, small_sizes, depth, stream, mode, scalar_term):
+    """Tests that the backward calculations produce the correct values, by doing a full (non-randomised) gradcheck."""
+    _gradcheck(class_, device, small_sizes, depth, stream, mode, scalar_term, fast_mode=False)
+
+
+def _gradcheck(class_, device, sizes, depth, stream, mode, scalar_term, fast_mode):
+    if fast_mode and not _gradcheck_has_fast_mode:
+        # Without fast_mode this would be a full gradcheck, which is too expensive for the sizes used here.
+        return
+    batch_size, input_stream, input_channels = sizes
+    path = h.get_path(batch_size, input_stream, input_channels, device, path_grad=False)
+    signature = signatory.signature(path, depth, stream=stream, scalar_term=scalar_term)
+    signature.requires_grad_()
+
+    def check_fn(signature):
+        return signatory_signature_to_logsignature(class_, signature, input_channels, depth, stream, mode, scalar_term)
+
+    kwargs = {}
+    if _gradcheck_has_fast_mode:
+        kwargs['fast_mode'] = fast_mode
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message="The logsignature with mode='brackets' has been requested on the "
+                                                  "GPU.", category=UserWarning)
+        autograd.gradcheck(check_fn, (signature,), atol=2e-05, rtol=0.002, check_undefined_grad=False,
+                           check_batched_grad=False, **kwargs)
+
+
+def _test_backward(class_, device, sizes, depth, stream, mode, scalar_term):
+    batch_size, input_stream, input_channels = sizes
+
+    # A full gradcheck runs out of memory for the larger sizes, so here we only do the randomised (fast_mode) version,
+    # and additionally compare against the gradients of signatory.logsignature below. The full gradcheck is done in
+    # test_backward_gradcheck_exhaustive.
+    _gradcheck(class_, device, sizes, depth, stream, mode, scalar_term, fast_mode=True)
 
     path = h.get_path(batch_size, input_stream, input_channels, device, path_grad=True)
     signature = signatory.signature(path, depth, stream=stream, scalar_term=scalar_term)
@@ -147,27 +248,19 @@ def _test_backward(class_, device, batch_size, input_stream, input_channels, dep
     h.diff(path.grad, path_grad)
 
 
-def test_no_adjustments():
+@pytest.mark.parametrize('scalar_term', (False, True))
+@pytest.mark.parametrize('signature_grad', (False, True))
+@pytest.mark.parametrize('mode', h.all_modes)
+@pytest.mark.parametrize('stream', (False, True))
+@pytest.mark.parametrize('depth', (1, 2, 5))
+@pytest.mark.parametrize('device', devices)
+@pytest.mark.parametrize('class_', (False, True))
+def test_no_adjustments(class_, device, sizes, depth, stream, mode, signature_grad, scalar_term, signature_for):
     """Tests that no memory is modified that shouldn't be modified."""
-    for class_ in (False, True):
-        for device in h.get_devices():
-            for batch_size, input_stream, input_channels in h.random_sizes():
-                for depth in (1, 2, 5):
-                    for stream in (False, True):
-                        for mode in h.all_modes:
-                            for signature_grad in (False, True):
-                                for scalar_term in (False, True):
-                                    _test_no_adjustments(class_, device, batch_size, input_stream, input_channels,
-                                                         depth, stream, mode, signature_grad, scalar_term)
-
-
-def _test_no_adjustments(class_, device, batch_size, input_stream, input_channels, depth, stream, mode, signature_grad,
-                         scalar_term):
-    path = h.get_path(batch_size, input_stream, input_channels, device, path_grad=False)
-    signature = signatory.signature(path, depth, stream=stream, scalar_term=scalar_term)
+    batch_size, input_stream, input_channels = sizes
+    _, signature = signature_for(batch_size, input_stream, input_channels, device, depth, stream, scalar_term)
     signature_clone = signature.clone()
-    if signature_grad:
-        signature.requires_grad_()
+    signature.requires_grad_(signature_grad)
     with warnings.catch_warnings():
         warnings.filterwarnings('ignore', message="The logsignature with mode='brackets' has been requested on the "
                                                   "GPU.", category=UserWarning)
@@ -188,8 +281,14 @@ def _test_no_adjustments(class_, device, batch_size, input_stream, input_channel
         h.diff(grad, grad_clone)
 
 
-@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA not available')
-def test_repeat_and_memory_leaks():
+@pytest.mark.cuda_only
+@pytest.mark.parametrize('scalar_term', (False, True))
+@pytest.mark.parametrize('signature_grad', (False, True))
+@pytest.mark.parametrize('mode', h.all_modes)
+@pytest.mark.parametrize('stream', (False, True))
+@pytest.mark.parametrize('depth', (1, 2, 5))
+@pytest.mark.parametrize('class_', (False, True))
+def test_repeat_and_memory_leaks(class_, sizes, depth, stream, mode, signature_grad, scalar_term, signature_for):
     """Performs two separate tests.
 
     First, that the computations are deterministic, and always give the same result when run multiple times; in
@@ -197,37 +296,32 @@ def test_repeat_and_memory_leaks():
 
     Second, that there are no memory leaks.
     """
-    for class_ in (False, True):
-        for batch_size, input_stream, input_channels in h.random_sizes():
-            for depth in (1, 2, 5):
-                for stream in (False, True):
-                    for mode in h.all_modes:
-                        for signature_grad in (False, True):
-                            for scalar_term in (False, True):
-                                _test_repeat_and_memory_leaks(class_, batch_size, input_stream, input_channels, depth,
-                                                              stream, mode, signature_grad, scalar_term)
-
-
-def _test_repeat_and_memory_leaks(class_, batch_size, input_stream, input_channels, depth, stream, mode,
-                                  signature_grad, scalar_term):
-    cpu_path = h.get_path(batch_size, input_stream, input_channels, device='cpu', path_grad=False)
-    cpu_signature = signatory.signature(cpu_path, depth, stream=stream, scalar_term=scalar_term)
+    batch_size, input_stream, input_channels = sizes
+    _, cpu_signature = signature_for(batch_size, input_stream, input_channels, 'cpu', depth, stream, scalar_term)
     if class_:
-        signature_to_logsignature_instance = signatory.SignatureToLogsignature(input_channels, depth, stream=stream,
-                                                                               mode=mode, scalar_term=scalar_term)
+        signature_to_logsignature_instance = _SignatureToLogsignature(input_channels, depth, stream=stream, mode=mode,
+                                                                      scalar_term=scalar_term)
         cpu_logsignature = signature_to_logsignature_instance(cpu_signature)
     else:
         cpu_logsignature = signatory.signature_to_logsignature(cpu_signature, input_channels, depth, stream=stream,
                                                                mode=mode, scalar_term=scalar_term)
     cpu_grad = torch.rand_like(cpu_logsignature)
 
+    # Stage the inputs in pinned memory and copy them into the same device buffers every iteration, so that we're not
+    # measuring (or waiting on) pageable copies and fresh allocations.
+    cpu_signature = cpu_signature.pin_memory()
+    cpu_grad = cpu_grad.pin_memory()
+    cuda_signature_buffer = torch.empty_like(cpu_signature, device='cuda')
+    cuda_grad = torch.empty_like(cpu_grad, device='cuda')
+
     def one_iteration():
-        gc.collect()
+        # The full collection has already been done before the warmup iteration, so only the youngest generation
+        # needs collecting to free anything left over from the previous iteration.
+        gc.collect(0)
         torch.cuda.synchronize()
-        torch.cuda.reset_max_memory_allocated()
-        cuda_signature = cpu_signature.to('cuda')
-        if signature_grad:
-            cuda_signature.requires_grad_()
+        cuda_signature_buffer.copy_(cpu_signature, non_blocking=True)
+        # detach() so that we get a fresh leaf tensor each time, which shares memory with the buffer.
+        cuda_signature = cuda_signature_buffer.detach().requires_grad_(signature_grad)
         with warnings.catch_warnings():
             warnings.filterwarnings('ignore', message="The logsignature with mode='brackets' has been requested on the "
                                                       "GPU.", category=UserWarning)
@@ -241,11 +335,17 @@ def _test_repeat_and_memory_leaks(class_, batch_size, input_stream, input_channe
         h.diff(cuda_logsignature.cpu(), cpu_logsignature)
 
         if signature_grad:
-            cuda_grad = cpu_grad.cuda()
+            cuda_grad.copy_(cpu_grad, non_blocking=True)
             cuda_logsignature.backward(cuda_grad)
         torch.cuda.synchronize()
-        return torch.cuda.max_memory_allocated()
-
+        return torch.cuda.memory_stats()['allocated_bytes.all.peak']
+
+    # The peak is only reset once, before the warmup iteration, so every later iteration reports the peak across all
+    # iterations so far, and any growth shows up. Garbage left over from earlier tests is freed first, so that it
+    # doesn't count towards the baseline.
+    gc.collect()
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
     memory_used = one_iteration()
     for repeat in range(10):
         # This one seems to be a bit inconsistent with how much memory is used on each run, so we give some